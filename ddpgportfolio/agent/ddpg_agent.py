@@ -1,13 +1,12 @@
 from dataclasses import dataclass, field
-from typing import Optional, Tuple, Union
+from typing import Callable, Optional, Tuple, Union
 
 import matplotlib.pyplot as plt
-import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
 
-from ddpgportfolio.agent.models import Actor, Critic
+from ddpgportfolio.agent.models import Actor, Critic, DDPGPolicy
 from ddpgportfolio.dataset import (
     KrakenDataSet,
 )
@@ -23,6 +22,7 @@ from utilities.pg_utils import (
     compute_entropy,
     normalize_batch_rewards,
     plot_performance,
+    softmax_drop_first,
 )
 
 torch.set_default_device("mps")
@@ -51,24 +51,36 @@ class DDPGAgent:
     pvm: PortfolioVectorMemory = field(init=False)
     replay_memory: PrioritizedReplayMemory = field(init=False)
     ou_noise: OrnsteinUhlenbeckNoise = field(init=False)
+    policy: DDPGPolicy = field(init=False)
 
     gamma: float = 0.9
     tau: float = 0.05
-    epsilon: float = 1.0
+    # initial exploration state, tracked by self.policy once created
+    initial_epsilon: float = 1.0
     epsilon_max: float = 1.0
     epsilon_min: float = 0.01
     epsilon_decay_rate: float = 1e-5
-    episode_count: int = 0
+    initial_episode_count: int = 0
     warmup_steps: int = 6000
+    num_workers: int = 4
+    use_torch_compile: bool = False
+    _softmax_drop_first: Callable = field(init=False, repr=False)
 
     def __post_init__(self):
         # create dataset and dataloaders for proper iteration
-        kraken_ds = KrakenDataSet(self.portfolio, self.window_size, self.step_size)
+        # price tensors are built on cpu so that iterating the dataloader can use
+        # worker processes, pinned host memory needs cuda so it is skipped on mps
+        kraken_ds = KrakenDataSet(
+            self.portfolio, self.window_size, self.step_size, device="cpu"
+        )
 
         self.dataloader = DataLoader(
             kraken_ds,
             batch_size=self.batch_size,
-            pin_memory=True,
+            num_workers=self.num_workers,
+            persistent_workers=self.num_workers > 0,
+            prefetch_factor=2 if self.num_workers > 0 else None,
+            pin_memory=torch.cuda.is_available(),
             generator=torch.Generator(device=self.device),
         )
 
@@ -78,25 +90,47 @@ class DDPGAgent:
         self.actor = Actor(3, m_noncash_assets)
         self.critic = Critic(3, m_assets)
 
-        self.actor_optimizer = torch.optim.Adam(
-            self.actor.parameters(),
-            lr=1e-5,
-            weight_decay=1e-5,
-        )
-        self.critic_optimizer = torch.optim.Adam(
-            self.critic.parameters(),
-            lr=1e-5,
-            weight_decay=1e-5,
-        )
         self.actor.to(self.device)
         self.critic.to(self.device)
+        self.actor_optimizer = self._make_optimizer(self.actor.parameters())
+        self.critic_optimizer = self._make_optimizer(self.critic.parameters())
+
+        # shapes are fixed for the whole run once m_assets and window_size are
+        # known, so compile static graphs for both networks
+        if self.use_torch_compile:
+            self.actor = torch.compile(self.actor, dynamic=False)
+            self.critic = torch.compile(self.critic, dynamic=False)
 
         # loss function for the critic
         self.loss_fn = nn.MSELoss()
 
+        # softmax over the actor logits keeping only non cash weights, compiling
+        # lets inductor fuse the softmax with the slice
+        self._softmax_drop_first = (
+            torch.compile(softmax_drop_first)
+            if self.use_torch_compile
+            else softmax_drop_first
+        )
+
         # ou noise initialization
         self.ou_noise = OrnsteinUhlenbeckNoise(size=m_assets, theta=0.20, sigma=0.5)
 
+        # exploration policy selecting actions for single states or sequences of
+        # states, it owns the epsilon schedule and the step count
+        self.policy = DDPGPolicy(
+            self.actor,
+            self.ou_noise,
+            warmup_steps=self.warmup_steps,
+            epsilon=self.initial_epsilon,
+            epsilon_max=self.epsilon_max,
+            epsilon_min=self.epsilon_min,
+            epsilon_decay_rate=self.epsilon_decay_rate,
+            episode_count=self.initial_episode_count,
+            softmax=self._softmax_drop_first,
+        ).to(self.device)
+        if self.use_torch_compile:
+            self.policy = torch.compile(self.policy)
+
         # initializing pvm with all cash initially
         self.pvm = PortfolioVectorMemory(self.portfolio.n_samples, m_noncash_assets)
         self.pvm.update_memory_stack(
@@ -106,9 +140,16 @@ class DDPGAgent:
             capacity=20000,
         )
 
-    def select_uniform_action(self, m):
-        uniform_vec = np.random.uniform(0, 1, size=m)
-        return torch.tensor(uniform_vec / np.sum(uniform_vec), dtype=torch.float32)
+    def _make_optimizer(self, parameters) -> torch.optim.Optimizer:
+        """Adam with the fused kernel when the device supports it, otherwise the
+        multi tensor foreach implementation"""
+        parameters = list(parameters)
+        try:
+            return torch.optim.Adam(parameters, lr=1e-5, weight_decay=1e-5, fused=True)
+        except RuntimeError:
+            return torch.optim.Adam(
+                parameters, lr=1e-5, weight_decay=1e-5, foreach=True
+            )
 
     def select_action(
         self,
@@ -124,65 +165,79 @@ class DDPGAgent:
             _description_
         exploration : bool, optional
             _description_, by default False
+        action_type : str, optional
+            one of "hybrid", "ou" or "greedy", by default "greedy"
 
         Returns
         -------
-        _type_
-            _description_
+        torch.tensor, dim = (m_noncash_assets,)
+            non cash weights at time t
         """
         self.actor.eval()
 
         with torch.no_grad():
-            action_logits = self.actor(state)
-        if exploration:
-            if action_type == "hybrid":
-                if self.episode_count < self.warmup_steps:
-                    action = self.select_uniform_action(self.portfolio.m_assets)
-                    self.episode_count += 1
-                    return action[1:]
-                else:
-                    # transition to ou noise after warm up steps
-                    action_type = "ou"
-            if action_type == "ou":
-                noise = self.ou_noise.sample()
-                action_logits += noise
-                self.ou_noise.decay_sigma()
-
-            elif action_type == "greedy" and np.random.rand() < self.epsilon:
-                action = self.get_uniform_action(self.portfolio.m_assets)
-                self.update_epsilon()
-                return action[1:]
-
-        action = torch.softmax(action_logits.view(-1), dim=-1)
-
-        # return all non-cash weights
-        return action[1:]
+            return self.policy(state, exploration, action_type)
 
-    def update_epsilon(self):
-        if self.episode_count < self.warmup_steps:
-            self.epsilon = (
-                self.epsilon_max
-                - ((self.epsilon_max - 0.5) / self.warmup_steps) * self.episode_count
-            )
+    def select_action_batch(
+        self,
+        state: Tuple[torch.tensor, torch.tensor],
+        exploration: bool = False,
+        action_type: Union[str, str] = "hybrid",
+    ):
+        """Select actions for a sequence of states in one forward pass of the actor.
+        Follows the same exploration schedule as calling select_action on each state
+        in order, so the actions have the same distribution but not the same values
 
-        else:
-            self.epsilon = max(
-                self.epsilon_min,
-                self.epsilon
-                * np.exp(
-                    -self.epsilon_decay_rate * (self.episode_count - self.warmup_steps)
-                ),
-            )
-        self.episode_count += 1
+        Parameters
+        ----------
+        state : Tuple[torch.tensor, torch.tensor]
+            batch of price tensors Xt and previous non cash weights w(t-1)
+        exploration : bool, optional
+            _description_, by default False
+        action_type : str, optional
+            one of "hybrid" or "ou", by default "hybrid"
+
+        Returns
+        -------
+        torch.tensor, dim = (batch_size, m_noncash_assets)
+            non cash weights for every state
+        """
+        self.actor.eval()
+
+        with torch.no_grad():
+            return self.policy.forward_batch(state, exploration, action_type)
+
+    @property
+    def epsilon(self) -> float:
+        """current exploration rate held by the policy"""
+        return self.policy.epsilon.item()
+
+    @epsilon.setter
+    def epsilon(self, value: float):
+        self.policy.epsilon.copy_(torch.as_tensor(value))
+
+    @property
+    def episode_count(self) -> int:
+        """number of exploration steps taken by the policy"""
+        return int(self.policy.episode_count)
+
+    @episode_count.setter
+    def episode_count(self, value: int):
+        self.policy.episode_count.copy_(torch.as_tensor(value))
+
+    def update_epsilon(self):
+        self.policy.update_epsilon()
 
     def update_target_networks(self):
         self.soft_update(self.target_actor, self.actor, self.tau)
         self.soft_update(self.target_critic, self.critic, self.tau)
 
+    @torch.no_grad()
     def soft_update(
         self, target_network: nn.Module, main_network: nn.Module, tau: float
     ):
-        """_summary_
+        """performs the polyak update target = tau * main + (1 - tau) * target
+        over all parameters at once using fused foreach kernels
 
         Parameters
         ----------
@@ -193,12 +248,10 @@ class DDPGAgent:
         tau : float
             _description_
         """
-        for target_param, main_param in zip(
-            target_network.parameters(), main_network.parameters()
-        ):
-            target_param.data.copy_(
-                tau * main_param.data + (1.0 - tau) * target_param.data
-            )
+        target_params = [p.data for p in target_network.parameters()]
+        main_params = [p.data for p in main_network.parameters()]
+        torch._foreach_mul_(target_params, 1.0 - tau)
+        torch._foreach_add_(target_params, main_params, alpha=tau)
 
     def train_actor(
         self, experience: Experience, is_weights: torch.tensor, beta: float = 0.05
@@ -217,15 +270,11 @@ class DDPGAgent:
         _type_
             _description_
         """
-        self.actor_optimizer.zero_grad()
+        self.actor_optimizer.zero_grad(set_to_none=True)
         logits = self.actor(experience.state)
         predicted_actions = torch.softmax(logits, dim=1)
         xt, previous_noncash_actions = experience.state
-        cash_weight_previous = 1 - previous_noncash_actions.sum(dim=1)
-        previous_action = torch.cat(
-            [cash_weight_previous.unsqueeze(1), previous_noncash_actions], dim=1
-        )
-        state = (xt, previous_action)
+        state = (xt, self._pad_cash(previous_noncash_actions))
 
         # actor has to choose action that maximizes the q value
         # hence we compute the q value and maximize this value
@@ -238,7 +287,12 @@ class DDPGAgent:
         actor_loss.backward()
         # torch.nn.utils.clip_grad_norm_(self.actor.parameters(), max_norm=1.0)
         self.actor_optimizer.step()
-        return predicted_actions[:, 1:], actor_loss.item()
+        return predicted_actions[:, 1:], actor_loss.detach()
+
+    def _pad_cash(self, noncash_weights: torch.tensor) -> torch.tensor:
+        """prepends the cash weight 1 - sum(noncash_weights) to each row"""
+        cash_weight = 1 - noncash_weights.sum(dim=1, keepdim=True)
+        return torch.cat([cash_weight, noncash_weights], dim=1)
 
     def _normalize_batch_rewards(self, rewards):
         mean = rewards.mean()
@@ -262,24 +316,17 @@ class DDPGAgent:
         _type_
             _description_
         """
-        self.critic_optimizer.zero_grad()
+        self.critic_optimizer.zero_grad(set_to_none=True)
         # critic needs to evaluate good an action is in a state
         # hence we need to add the cash weight back otherwise its biased
         xt, previous_noncash_actions = experience.state
         reward = experience.reward
-        cash_weight_previous = 1 - previous_noncash_actions.sum(dim=1)
 
-        # previous action includes cash weight now
-        previous_action = torch.cat(
-            [cash_weight_previous.unsqueeze(1), previous_noncash_actions], dim=1
-        )
-        # construct st = (Xt, wt-1)
-        state = (xt, previous_action)
+        # construct st = (Xt, wt-1), previous action includes cash weight now
+        state = (xt, self._pad_cash(previous_noncash_actions))
 
         # we need to do the same for action wt at time t
-        noncash_actions = experience.action
-        cash_weight_action = 1 - noncash_actions.sum(dim=1)
-        actions = torch.cat([cash_weight_action.unsqueeze(1), noncash_actions], dim=1)
+        actions = self._pad_cash(experience.action)
         predicted_q_values = self.critic(state, actions)
 
         # calculate target q values using bellman equation
@@ -294,7 +341,7 @@ class DDPGAgent:
         critic_loss.backward()
         torch.nn.utils.clip_grad_norm_(self.critic.parameters(), max_norm=1.0)
         self.critic_optimizer.step()
-        return td_error, critic_loss.item()
+        return td_error, critic_loss.detach()
 
     def warm_up_critic(self, n_iterations: int = 100):
         """Warm-up the critic network using the replay buffer before training the actor.
@@ -332,30 +379,32 @@ class DDPGAgent:
 
         n_samples = len(kraken_ds)
 
-        for i in range(1, n_samples + 49):
-            xt, prev_index = kraken_ds[i - 1]
-            previous_action = self.pvm.get_memory_stack(prev_index)
-            state = (xt, previous_action)
-
-            # get current weight from actor network given s = (Xt, wt_prev)
-            action = self.select_action(
-                state, exploration=True, action_type="hybrid"
-            ).detach()
-
-            # store the current action into pvm
-            # self.pvm.update_memory_stack(action, prev_index + 1)
-
-            # get the relative price vector from price tensor to calculate reward
-            yt = 1 / xt[0, :, -2]
-            reward = self.portfolio.get_reward(action, yt, previous_action)
-            # reward_normalizer.update(reward.item())
-            # normalized_reward = reward_normalizer.normalize(reward.item())
-            xt_next, _ = kraken_ds[i]
-            next_state = (xt_next, action)
-            experience = Experience(
-                state, action, reward.item(), next_state, prev_index
-            )
-            self.replay_memory.add(experience=experience, reward=reward.item())
+        # price tensors for every window, experience t uses windows t and t+1
+        xt_all, prev_indices = kraken_ds.as_tensor()
+        xt, xt_next = xt_all[:-1], xt_all[1:]
+        prev_indices = prev_indices[:-1]
+        previous_actions = self.pvm.get_memory_stack(prev_indices)
+        state = (xt, previous_actions)
+
+        # get current weights from actor network given s = (Xt, wt_prev)
+        actions = self.select_action_batch(
+            state, exploration=True, action_type="hybrid"
+        ).detach()
+
+        # store the current action into pvm
+        # self.pvm.update_memory_stack(actions, prev_indices + 1)
+
+        # get the relative price vector from price tensor to calculate reward
+        yt = 1 / xt[:, 0, :, -2]
+        rewards = self.portfolio.get_reward(actions, yt, previous_actions)
+        # reward_normalizer.update_batch(rewards.cpu().numpy())
+        # rewards = reward_normalizer.normalize(rewards)
+
+        # one batched experience, written to the replay buffers in a single pass
+        experience = Experience(
+            state, actions, rewards, (xt_next, actions), prev_indices
+        )
+        self.replay_memory.add_batch(experience, rewards.cpu().numpy())
         print("pretraining done")
 
         print(f"buffer size: {len(self.replay_memory)}")
@@ -366,7 +415,13 @@ class DDPGAgent:
         # Critic warm-up phase
         # self.warm_up_critic(n_iterations=200)
 
-    def train(self, n_episodes: int = 50, n_iterations_per_episode: int = 20):
+    def train(
+        self,
+        n_episodes: int = 50,
+        n_iterations_per_episode: int = 20,
+        batches_per_step: int = 1,
+        plot: bool = True,
+    ):
         """Train the agent by training the actor and critic networks
 
         Parameters
@@ -375,14 +430,30 @@ class DDPGAgent:
             _description_, by default 50
         n_iterations_per_episode : int, optional
             _description_, by default 20
+        batches_per_step : int, optional
+            number of minibatches fused into each gradient step, the number of
+            iterations per episode is divided by it so each episode samples the
+            same number of experiences.  Must divide n_iterations_per_episode,
+            by default 1
+        plot : bool, optional
+            show the performance plots, otherwise save them to png files so
+            automated runs do not block, by default True
 
         Raises
         ------
         Exception
             _description_
+        ValueError
+            if batches_per_step is not a positive divisor of
+            n_iterations_per_episode
         """
         if len(self.replay_memory) == 0:
             raise Exception("replay memory is empty.  Please pre-train agent")
+        if batches_per_step < 1 or n_iterations_per_episode % batches_per_step:
+            raise ValueError(
+                f"batches_per_step={batches_per_step} must be a positive divisor of "
+                f"n_iterations_per_episode={n_iterations_per_episode}"
+            )
 
         print("Training Started for DDPG Agent")
         # scheduler to perform learning rate decay
@@ -394,6 +465,7 @@ class DDPGAgent:
         )
         # Training loop
         batch_size = self.batch_size
+        n_steps = n_iterations_per_episode // batches_per_step
 
         critic_losses = []
         actor_losses = []
@@ -401,15 +473,16 @@ class DDPGAgent:
 
         for episode in range(n_episodes):
             # Initialize accumulators for the losses
-            episode_actor_loss = 0
-            episode_critic_loss = 0
-            total_episodic_reward = 0
+            # kept on device so the loop does not sync with the host each iteration
+            episode_actor_loss = torch.zeros((), device=self.device)
+            episode_critic_loss = torch.zeros((), device=self.device)
+            total_episodic_reward = torch.zeros((), device=self.device)
 
             # Loop over iterations within the current episode
-            for iteration in range(n_iterations_per_episode):
+            for iteration in range(n_steps):
                 # Sample a batch of experiences from the replay buffer
                 experiences, indices, is_weights = self.replay_memory.sample(
-                    batch_size=batch_size
+                    batch_size=batch_size * batches_per_step
                 )
 
                 # get the reward
@@ -430,15 +503,22 @@ class DDPGAgent:
                 # Accumulate the losses over the iterations for logging
                 episode_actor_loss += actor_loss
                 episode_critic_loss += critic_loss
-                total_episodic_reward += reward.sum().item()
+                total_episodic_reward += reward.sum()
 
                 # Update the learning rate scheduler
                 critic_scheduler.step()
                 actor_scheduler.step()
 
             # After finishing the iterations for the episode, log the average losses
-            avg_episode_actor_loss = episode_actor_loss / (n_iterations_per_episode)
-            avg_episode_critic_loss = episode_critic_loss / (n_iterations_per_episode)
+            episode_actor_loss, episode_critic_loss, total_episodic_reward = (
+                torch.stack(
+                    [episode_actor_loss, episode_critic_loss, total_episodic_reward]
+                )
+                .cpu()
+                .tolist()
+            )
+            avg_episode_actor_loss = episode_actor_loss / n_steps
+            avg_episode_critic_loss = episode_critic_loss / n_steps
             actor_losses.append(avg_episode_actor_loss)
             critic_losses.append(avg_episode_critic_loss)
             rewards.append(total_episodic_reward / batch_size)
@@ -452,4 +532,4 @@ class DDPGAgent:
 
         print("Training complete!")
         # performance plots
-        plot_performance(actor_losses, critic_losses, rewards)
+        plot_performance(actor_losses, critic_losses, rewards, plot=plot)
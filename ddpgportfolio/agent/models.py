@@ -3,11 +3,17 @@
 # Actor will estimate the policy
 # Critic will estimate the Q value function
 
-from typing import Tuple
+from typing import Callable, Optional, Tuple
 
+import numpy as np
 import torch
 import torch.nn as nn
 
+from utilities.pg_utils import OrnsteinUhlenbeckNoise, softmax_drop_first
+
+# upper bound on the length of the precomputed epsilon decay table
+MAX_EPSILON_DECAY_STEPS = 100000
+
 
 def weights_init(m):
     if isinstance(m, nn.Conv2d):
@@ -182,3 +188,217 @@ class Critic(nn.Module):
         # estimate the q value
         q_value = self.q_layer(combined)
         return q_value.view(-1)
+
+
+class DDPGPolicy(nn.Module):
+    def __init__(
+        self,
+        actor: Actor,
+        ou_noise: OrnsteinUhlenbeckNoise,
+        warmup_steps: int = 6000,
+        epsilon: float = 1.0,
+        epsilon_max: float = 1.0,
+        epsilon_min: float = 0.01,
+        epsilon_decay_rate: float = 1e-5,
+        episode_count: int = 0,
+        softmax: Callable = softmax_drop_first,
+    ):
+        """Exploration policy around the actor.  Selects the non cash weights for
+        a single state with the exploration schedule kept in device buffers, so
+        the data dependent branches are tensor ops and the module can be compiled.
+        forward_batch applies the same schedule to a sequence of states
+
+        Parameters
+        ----------
+        actor : Actor
+            actor network producing the logits
+        ou_noise : OrnsteinUhlenbeckNoise
+            ou process shared with the agent
+        warmup_steps : int, optional
+            number of uniformly random steps before exploring, default=6000
+        epsilon : float, optional
+            initial exploration rate for greedy exploration, default=1.0
+        epsilon_max : float, optional
+            exploration rate at the start of warm up, default=1.0
+        epsilon_min : float, optional
+            lower bound of the exploration rate, default=0.01
+        epsilon_decay_rate : float, optional
+            decay rate of the exploration rate after warm up, default=1e-5
+        episode_count : int, optional
+            number of steps already taken, default=0
+        softmax : Callable, optional
+            softmax over the logits keeping only the non cash weights,
+            default=softmax_drop_first
+        """
+        super(DDPGPolicy, self).__init__()
+        self.actor = actor
+        self.ou_noise = ou_noise
+        self.warmup_steps = warmup_steps
+        self.epsilon_min = epsilon_min
+        self.softmax_drop_first = softmax
+
+        # epsilon schedule is fixed by the constants above, so precompute the
+        # linear warm up values and the per step decay factors used afterwards
+        epsilon_warmup = epsilon_max - (
+            (epsilon_max - 0.5) / max(warmup_steps, 1)
+        ) * np.arange(max(warmup_steps, 1))
+        if epsilon_decay_rate < 0:
+            raise ValueError("epsilon_decay_rate must be non negative")
+        if epsilon_decay_rate == 0:
+            # no decay, every step multiplies epsilon by 1
+            n_decay_steps = 0
+        elif epsilon_min <= 0:
+            # epsilon never reaches a floor of zero, so cap the table
+            n_decay_steps = MAX_EPSILON_DECAY_STEPS
+        else:
+            # the decay compounds, so epsilon reaches epsilon_min after n steps where
+            # decay_rate * n * (n + 1) / 2 >= log(epsilon_max / epsilon_min)
+            log_ratio = max(np.log(epsilon_max / epsilon_min), 0.0)
+            n_decay_steps = min(
+                int(np.ceil(np.sqrt(2 * log_ratio / epsilon_decay_rate))),
+                MAX_EPSILON_DECAY_STEPS,
+            )
+        epsilon_decay = np.exp(-epsilon_decay_rate * np.arange(n_decay_steps + 1))
+
+        self.register_buffer("episode_count", torch.tensor(episode_count))
+        self.register_buffer("epsilon", torch.tensor(epsilon, dtype=torch.float32))
+        self.register_buffer(
+            "epsilon_warmup", torch.tensor(epsilon_warmup, dtype=torch.float32)
+        )
+        self.register_buffer(
+            "epsilon_decay", torch.tensor(epsilon_decay, dtype=torch.float32)
+        )
+
+    def update_epsilon(self, mask: torch.tensor = None):
+        """advances the epsilon schedule by one step, only where mask is true if
+        a mask is given"""
+        episode_count = self.episode_count
+        # the tables are indexed with index_select, indexing with a 0-dim tensor
+        # would read the index back to the host
+        warmup_step = episode_count.clamp(max=len(self.epsilon_warmup) - 1)
+        warmup_epsilon = self.epsilon_warmup.index_select(0, warmup_step.view(1))
+        # past the end of the table epsilon has already reached epsilon_min, or
+        # the last factor is reused when the table was capped
+        decay_step = (episode_count - self.warmup_steps).clamp(
+            0, len(self.epsilon_decay) - 1
+        )
+        decay = self.epsilon_decay.index_select(0, decay_step.view(1))
+        decayed_epsilon = (self.epsilon * decay.squeeze(0)).clamp(min=self.epsilon_min)
+        epsilon = torch.where(
+            episode_count < self.warmup_steps,
+            warmup_epsilon.squeeze(0),
+            decayed_epsilon,
+        )
+        if mask is None:
+            self.epsilon.copy_(epsilon)
+            self.episode_count.add_(1)
+        else:
+            self.epsilon.copy_(torch.where(mask, epsilon, self.epsilon))
+            self.episode_count.add_(mask.long())
+
+    def uniform_action(self, m: int, n: Optional[int] = None) -> torch.tensor:
+        """draws portfolio weights over m assets uniformly at random, a single
+        vector of dim (m,) or a batch of dim (n, m) if n is given"""
+        size = (m,) if n is None else (n, m)
+        uniform = torch.rand(size, device=self.episode_count.device)
+        return uniform / uniform.sum(dim=-1, keepdim=True)
+
+    def forward(
+        self,
+        state: Tuple[torch.tensor, torch.tensor],
+        exploration: bool = False,
+        action_type: str = "greedy",
+    ) -> torch.tensor:
+        """selects the action for a single state
+
+        Parameters
+        ----------
+        state : Tuple[torch.tensor, torch.tensor]
+            price tensor Xt and previous non cash weights w(t-1)
+        exploration : bool, optional
+            explore according to action_type, default=False
+        action_type : str, optional
+            one of "hybrid", "ou" or "greedy", default="greedy"
+            hybrid takes uniform actions for warmup_steps and ou noise after
+            ou adds ou noise to the logits
+            greedy takes a uniform action with probability epsilon
+
+        Returns
+        -------
+        torch.tensor, dim = (m_noncash_assets,)
+            non cash weights at time t
+        """
+        logits = self.actor(state).view(-1)
+        if not exploration:
+            return self.softmax_drop_first(logits)
+
+        if action_type == "ou":
+            logits = logits + self.ou_noise.sample()
+            self.ou_noise.decay_sigma()
+            return self.softmax_drop_first(logits)
+
+        uniform = self.uniform_action(logits.shape[-1])
+        if action_type == "hybrid":
+            # uniform during warm up, ou noise afterwards
+            explore = self.episode_count < self.warmup_steps
+            self.episode_count.add_(explore.long())
+            logits = logits + self.ou_noise.sample(mask=~explore)
+            self.ou_noise.decay_sigma(mask=~explore)
+        elif action_type == "greedy":
+            explore = torch.rand((), device=logits.device) < self.epsilon
+            self.update_epsilon(mask=explore)
+        else:
+            raise ValueError(f"unsupported action type: {action_type}")
+
+        action = torch.where(explore, uniform, torch.softmax(logits, dim=-1))
+        return action[1:]
+
+    def forward_batch(
+        self,
+        state: Tuple[torch.tensor, torch.tensor],
+        exploration: bool = False,
+        action_type: str = "hybrid",
+    ) -> torch.tensor:
+        """selects the actions for a sequence of states in one forward pass of the
+        actor.  The exploration schedule advances as if forward was called on each
+        state in order, so the actions have the same distribution, but the random
+        draws are made in a different order and the actions themselves differ
+
+        Parameters
+        ----------
+        state : Tuple[torch.tensor, torch.tensor]
+            batch of price tensors Xt and previous non cash weights w(t-1)
+        exploration : bool, optional
+            explore according to action_type, default=False
+        action_type : str, optional
+            one of "hybrid" or "ou", default="hybrid"
+
+        Returns
+        -------
+        torch.tensor, dim = (batch_size, m_noncash_assets)
+            non cash weights for every state
+        """
+        logits = self.actor(state)
+        if not exploration:
+            return self.softmax_drop_first(logits)
+        if action_type not in ("hybrid", "ou"):
+            raise ValueError(f"unsupported batch action type: {action_type}")
+
+        batch_size = logits.shape[0]
+        n_uniform = 0
+        if action_type == "hybrid":
+            # the first steps up to warmup_steps are uniformly random
+            n_uniform = min(
+                max(self.warmup_steps - int(self.episode_count), 0), batch_size
+            )
+            self.episode_count.add_(n_uniform)
+
+        # remaining steps follow the ou process, advanced for all of them at once
+        if batch_size > n_uniform:
+            logits[n_uniform:] += self.ou_noise.sample_batch(batch_size - n_uniform)
+
+        action = self.softmax_drop_first(logits)
+        if n_uniform > 0:
+            uniform = self.uniform_action(logits.shape[-1], n_uniform)
+            action[:n_uniform] = uniform[:, 1:]
+        return action
@@ -35,21 +35,59 @@ class KrakenDataSet(Dataset):
         ).to(device)
         self.device = device
 
+        # sliding windows over the prices as views, no data is copied
+        # dim = (n_windows, m_noncash_assets, window_size)
+        self._close_windows = self.close_pr.unfold(0, self.window_size, self.step_size)
+        self._high_windows = self.high_pr.unfold(0, self.window_size, self.step_size)
+        self._low_windows = self.low_pr.unfold(0, self.window_size, self.step_size)
+
+        # windows must end strictly before the last price
+        self.n_windows = (
+            len(self.close_pr) - self.window_size - 1
+        ) // self.step_size + 1
+
     def __len__(self):
         return self.portfolio.n_samples - self.start_index - self.window_size
 
+    def _price_tensor(self, idx):
+        """normalizes the close, high and low windows at idx by the last close"""
+        close_pr = self._close_windows[idx]
+        last_close = close_pr[..., -1:]
+        return torch.stack(
+            [
+                close_pr / last_close,
+                self._high_windows[idx] / last_close,
+                self._low_windows[idx] / last_close,
+            ],
+            dim=-3,
+        )
+
     def __getitem__(self, idx):
-        m_noncash_assets = self.portfolio.m_noncash_assets
         start = idx * self.step_size
         end = start + self.window_size
 
-        if end >= len(self.close_pr):
+        if idx >= self.n_windows:
             raise IndexError(f"End index {end} exceeds data length.")
 
         # the price tensor
-        xt = torch.zeros(3, m_noncash_assets, self.window_size).to(self.device)
-        xt[0] = (self.close_pr[start:end,] / self.close_pr[end - 1,]).T
-        xt[1] = (self.high_pr[start:end,] / self.close_pr[end - 1,]).T
-        xt[2] = (self.low_pr[start:end,] / self.close_pr[end - 1,]).T
+        xt = self._price_tensor(idx)
 
         return xt, end - 2
+
+    def as_tensor(self):
+        """returns the price tensors Xt for every valid window stacked along the
+        first dimension, equivalent to indexing the dataset for each window
+
+        Returns
+        -------
+        Tuple[torch.tensor, torch.tensor]
+            price tensors, dim = (n_windows, 3, m_noncash_assets, window_size)
+            and the index of the previous period for each window
+        """
+        xt = self._price_tensor(slice(0, self.n_windows))
+        prev_indices = (
+            torch.arange(self.n_windows, device=self.device) * self.step_size
+            + self.window_size
+            - 2
+        )
+        return xt, prev_indices
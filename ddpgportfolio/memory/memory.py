@@ -1,6 +1,6 @@
 from collections import deque
 from dataclasses import dataclass, field
-from typing import List, Optional, Tuple
+from typing import Optional, Tuple
 
 import numpy as np
 import torch
@@ -28,9 +28,15 @@ class PortfolioVectorMemory:
         self.memory = self.memory.to(self.device)
 
     def update_memory_stack(self, new_weights: torch.tensor, indices: torch.tensor):
-        self.memory[indices] = new_weights
+        if isinstance(indices, torch.Tensor) and indices.dim() == 1:
+            # batched write of every row in a single kernel
+            self.memory.index_copy_(0, indices.to(self.device), new_weights)
+        else:
+            self.memory[indices] = new_weights
 
     def get_memory_stack(self, indices):
+        if isinstance(indices, torch.Tensor) and indices.dim() == 1:
+            return self.memory.index_select(0, indices.to(self.device))
         return self.memory[indices]
 
 
@@ -89,21 +95,168 @@ class PrioritizedReplayMemory:
     alpha_decay_rate: Optional[float] = 0.001
     min_priority: float = 0.1
     device: Optional[str] = "mps"
-    buffer: List[Experience] = field(init=False, default_factory=lambda: [])
+    storage_dtype: torch.dtype = torch.float16
     pos: int = field(init=False, default=0)
-    priorities: List[float] = field(init=False, default_factory=lambda: [])
+    size: int = field(init=False, default=0)
+    xt_buffer: torch.tensor = field(init=False, default=None)
+    prev_action_buffer: torch.tensor = field(init=False, default=None)
+    action_buffer: torch.tensor = field(init=False, default=None)
+    reward_buffer: torch.tensor = field(init=False, default=None)
+    next_xt_buffer: torch.tensor = field(init=False, default=None)
+    prev_index_buffer: torch.tensor = field(init=False, default=None)
+    priorities: np.ndarray = field(init=False)
+    tree: np.ndarray = field(init=False)
+    tree_size: int = field(init=False)
+    tree_depth: int = field(init=False)
+    tree_alpha: float = field(init=False)
+
+    def __post_init__(self):
+        # raw priorities are kept so the tree can be rebuilt when alpha decays
+        self.priorities = np.zeros(self.capacity, dtype=np.float64)
+
+        # sum-tree over priorities**alpha, padded to a power of two so every
+        # leaf sits at the same depth and leaves are ordered by buffer index
+        self.tree_depth = int(np.ceil(np.log2(max(self.capacity, 2))))
+        self.tree_size = 2**self.tree_depth
+        self.tree = np.zeros(2 * self.tree_size - 1, dtype=np.float64)
+        self.tree_alpha = self.alpha
 
     def __repr__(self):
-        return f"Total Experiences: {len(self.buffer)}"
+        return f"Total Experiences: {len(self)}"
 
     def __len__(self):
-        return len(self.buffer)
-
-    def peek_buffer(self):
-        return self.buffer[-1]
+        return self.size
+
+    def peek_buffer(self) -> Experience:
+        """returns the most recently added experience without a batch dimension"""
+        batch = self._gather(np.array([(self.pos - 1) % self.capacity]))
+        (xt, prev_action), (next_xt, action) = batch.state, batch.next_state
+        return Experience(
+            (xt[0], prev_action[0]),
+            batch.action[0],
+            batch.reward[0],
+            (next_xt[0], action[0]),
+            batch.previous_index[0],
+        )
 
     def peek_priorities(self):
-        return self.priorities[-1]
+        return self.priorities[(self.pos - 1) % self.capacity]
+
+    def _allocate(self, xt: torch.tensor, action: torch.tensor):
+        """allocates fixed size cpu buffers for every field of an experience
+        given the price tensor and action of a single experience"""
+        # pinned host memory needs cuda, mps already shares memory with the host
+        pin_memory = torch.cuda.is_available()
+
+        def empty(shape, dtype=torch.float32):
+            return torch.empty(
+                (self.capacity, *shape),
+                dtype=dtype,
+                device="cpu",
+                pin_memory=pin_memory,
+            )
+
+        # price tensors hold almost all of the memory and are stored at reduced
+        # precision.  Weights stay at float32 so that the cash weight recovered as
+        # 1 - sum(noncash) stays on the simplex, and rewards stay at float32 since
+        # their range matters for the td error
+        self.xt_buffer = empty(xt.shape, self.storage_dtype)
+        self.prev_action_buffer = empty(action.shape)
+        self.action_buffer = empty(action.shape)
+        self.reward_buffer = empty(())
+        self.next_xt_buffer = empty(xt.shape, self.storage_dtype)
+        self.prev_index_buffer = empty((), dtype=torch.int64)
+
+    def _gather(self, indices: np.ndarray) -> Experience:
+        """gathers the experiences at indices into a batch on the memory device"""
+        idx = torch.as_tensor(indices, dtype=torch.int64, device="cpu")
+
+        def to_device(buffer):
+            # reduced precision buffers are upcast to float32 during the copy
+            dtype = torch.float32 if buffer.is_floating_point() else None
+            return buffer.index_select(0, idx).to(
+                self.device, dtype=dtype, non_blocking=True
+            )
+
+        action = to_device(self.action_buffer)
+        return Experience(
+            (
+                self._decode(to_device(self.xt_buffer)),
+                to_device(self.prev_action_buffer),
+            ),
+            action,
+            to_device(self.reward_buffer),
+            (self._decode(to_device(self.next_xt_buffer)), action),
+            to_device(self.prev_index_buffer),
+        )
+
+    def _encode(self, xt: torch.tensor) -> torch.tensor:
+        """price tensors are close to 1 since they are normalized by the last
+        close, where float16 steps are about 1e-3.  Storing xt - 1 brings the
+        round trip error down to about 1.5e-5 for prices within 3% of the close"""
+        return xt - 1
+
+    def _decode(self, xt: torch.tensor) -> torch.tensor:
+        return xt + 1
+
+    def _propagate_index(self, idx: int):
+        """sets the leaf for buffer position idx and updates its ancestors"""
+        node = idx + self.tree_size - 1
+        self.tree[node] = self.priorities[idx] ** self.tree_alpha
+        while node > 0:
+            node = (node - 1) // 2
+            self.tree[node] = self.tree[2 * node + 1] + self.tree[2 * node + 2]
+
+    def _propagate_indices(self, indices: np.ndarray):
+        """sets the leaves for a batch of buffer positions and updates the tree
+        one level at a time"""
+        nodes = np.unique(indices) + self.tree_size - 1
+        self.tree[nodes] = (
+            self.priorities[nodes - self.tree_size + 1] ** self.tree_alpha
+        )
+        for _ in range(self.tree_depth):
+            nodes = np.unique((nodes - 1) // 2)
+            self.tree[nodes] = self.tree[2 * nodes + 1] + self.tree[2 * nodes + 2]
+
+    def _rebuild_tree(self):
+        """recomputes every node of the tree from the raw priorities"""
+        self.tree_alpha = self.alpha
+        leaves = self.tree_size - 1
+        self.tree[leaves : leaves + self.capacity] = self.priorities**self.tree_alpha
+        start = leaves
+        for _ in range(self.tree_depth):
+            parents = np.arange((start - 1) // 2, start)
+            self.tree[parents] = self.tree[2 * parents + 1] + self.tree[2 * parents + 2]
+            start = (start - 1) // 2
+
+    def _prefix_sum(self, idx: int) -> float:
+        """returns the sum of priorities**alpha over buffer positions [0, idx)"""
+        if idx >= self.tree_size:
+            return self.tree[0]
+        node = idx + self.tree_size - 1
+        total = 0.0
+        while node > 0:
+            # a right child has its left sibling entirely before it
+            if node % 2 == 0:
+                total += self.tree[node - 1]
+            node = (node - 1) // 2
+        return total
+
+    def _retrieve(self, values: np.ndarray) -> np.ndarray:
+        """descends the tree for every value at once and returns buffer positions"""
+        nodes = np.zeros(len(values), dtype=np.int64)
+        for _ in range(self.tree_depth):
+            left = 2 * nodes + 1
+            go_left = values < self.tree[left]
+            values = np.where(go_left, values, values - self.tree[left])
+            nodes = np.where(go_left, left, left + 1)
+        return nodes - self.tree_size + 1
+
+    def _sample_range(self, start: int, end: int, size: int) -> np.ndarray:
+        """samples positions in [start, end) proportional to priority**alpha"""
+        low, high = self._prefix_sum(start), self._prefix_sum(end)
+        values = np.random.uniform(low, high, size=size)
+        return np.clip(self._retrieve(values), start, end - 1)
 
     def add(self, experience: Experience, reward: float):
         """_summary_
@@ -116,19 +269,61 @@ class PrioritizedReplayMemory:
             _description_
         """
         priority = abs(reward) + self.epsilon
-
-        if len(self.buffer) < self.capacity:
-            # add experiencs and their priority
-            self.buffer.append(experience)
-            self.priorities.append(priority)
-        else:
-            # overwrite experience at position pos
-            self.buffer[self.pos] = experience
-            self.priorities[self.pos] = priority
+        xt, prev_action = experience.state
+        if self.xt_buffer is None:
+            self._allocate(xt, experience.action)
+
+        # write the experience into slot pos, overwriting the oldest once full
+        self.xt_buffer[self.pos] = self._encode(xt)
+        self.prev_action_buffer[self.pos] = prev_action
+        self.action_buffer[self.pos] = experience.action
+        self.reward_buffer[self.pos] = experience.reward
+        self.next_xt_buffer[self.pos] = self._encode(experience.next_state[0])
+        self.prev_index_buffer[self.pos] = experience.previous_index
+        self.size = min(self.size + 1, self.capacity)
 
         self.priorities[self.pos] = max(priority, self.min_priority)
+        self._propagate_index(self.pos)
         self.pos = (self.pos + 1) % self.capacity
 
+    def add_batch(self, experience: Experience, rewards: np.ndarray):
+        """adds a batch of experiences with a single write per buffer and a single
+        update of the sum-tree
+
+        Parameters
+        ----------
+        experience : Experience
+            batch of experiences in the order they would have been added one at a time
+        rewards : np.ndarray
+            reward for each experience used to set its initial priority
+        """
+        xt, prev_action = experience.state
+        if self.xt_buffer is None:
+            self._allocate(xt[0], experience.action[0])
+
+        # only the most recent capacity experiences survive the ring buffer
+        n = len(rewards)
+        skip = max(n - self.capacity, 0)
+        self.pos = (self.pos + skip) % self.capacity
+        positions = (self.pos + np.arange(n - skip)) % self.capacity
+        idx = torch.as_tensor(positions, dtype=torch.int64, device="cpu")
+
+        self.xt_buffer[idx] = self._encode(xt[skip:]).to("cpu", self.storage_dtype)
+        self.prev_action_buffer[idx] = prev_action[skip:].cpu()
+        self.action_buffer[idx] = experience.action[skip:].cpu()
+        self.reward_buffer[idx] = experience.reward[skip:].cpu()
+        self.next_xt_buffer[idx] = self._encode(experience.next_state[0][skip:]).to(
+            "cpu", self.storage_dtype
+        )
+        self.prev_index_buffer[idx] = experience.previous_index[skip:].cpu()
+        self.size = min(self.size + n, self.capacity)
+
+        rewards = np.asarray(rewards, dtype=np.float64)[skip:]
+        priorities = np.abs(rewards) + self.epsilon
+        self.priorities[positions] = np.maximum(priorities, self.min_priority)
+        self._propagate_indices(positions)
+        self.pos = (self.pos + n - skip) % self.capacity
+
     def sample(
         self, batch_size, beta=0.4, p_recent=0.5
     ) -> Tuple[Tuple[Experience, torch.tensor, np.ndarray]]:
@@ -138,66 +333,35 @@ class PrioritizedReplayMemory:
             0.1, self.alpha - self.alpha_decay_rate
         )  # Ensure alpha doesn't go below 0.1
         self.beta = min(1.0, beta + self.beta_decay_rate)  # Gradually increase beta
+        if self.alpha != self.tree_alpha:
+            self._rebuild_tree()
 
         # Partition the buffer into recent and older sections
-        recent_cutoff = int(len(self.buffer) * 0.4)  # Top 20% of the buffer is recent
-        recent_indices = list(range(len(self.buffer) - recent_cutoff, len(self.buffer)))
-        older_indices = list(range(0, len(self.buffer) - recent_cutoff))
+        n_buffer = len(self)
+        recent_cutoff = int(n_buffer * 0.4)  # Top 20% of the buffer is recent
 
         # Number of samples from each partition
         n_recent = int(batch_size * p_recent)
         n_older = batch_size - n_recent
 
-        # Normalize the priorities within each partition
-        recent_priorities = np.array(self.priorities)[recent_indices] ** self.alpha
-        older_priorities = np.array(self.priorities)[older_indices] ** self.alpha
-
-        # Calculate probabilities for sampling
-        prob_recent = recent_priorities / recent_priorities.sum()
-        prob_older = older_priorities / older_priorities.sum()
-
-        # Sample indices from each partition
-        sampled_recent = np.random.choice(recent_indices, size=n_recent, p=prob_recent)
-        sampled_older = np.random.choice(older_indices, size=n_older, p=prob_older)
+        # Sample indices from each partition proportional to priority**alpha
+        sampled_recent = self._sample_range(
+            n_buffer - recent_cutoff, n_buffer, n_recent
+        )
+        sampled_older = self._sample_range(0, n_buffer - recent_cutoff, n_older)
 
         # Combine sampled indices and shuffle
         indices = np.concatenate([sampled_recent, sampled_older])
         np.random.shuffle(indices)
 
         # Compute importance-sampling weights for combined indices
-        combined_priorities = np.array(self.priorities)[indices]
-        prob_combined = (
-            combined_priorities**self.alpha / (combined_priorities**self.alpha).sum()
-        )
-        weights = (len(self.buffer) * prob_combined) ** -self.beta
+        combined_priorities = self.tree[indices + self.tree_size - 1]
+        prob_combined = combined_priorities / combined_priorities.sum()
+        weights = (n_buffer * prob_combined) ** -self.beta
         weights /= weights.max()  # Normalize to avoid large weights
 
-        # Extract the actual experiences from the buffer using the indices
-        experiences = [self.buffer[idx] for idx in indices]
-
-        xt, prev_action, action, reward, xt_next, prev_index = zip(
-            *[
-                (
-                    *(exp.state[0], exp.state[1]),
-                    exp.action,
-                    exp.reward,
-                    exp.next_state[0],
-                    exp.previous_index,
-                )
-                for exp in experiences
-            ]
-        )
-
-        xt = torch.stack(xt)
-        prev_action = torch.stack(prev_action)
-        action = torch.stack(action)
-        reward = torch.tensor(reward, dtype=torch.float32)
-        xt_next = torch.stack(xt_next)
-        prev_index = torch.tensor(prev_index)
-
-        experience = Experience(
-            (xt, prev_action), action, reward, (xt_next, action), prev_index
-        )
+        # Gather the experiences into one batch per field on the device
+        experience = self._gather(indices)
 
         weights = torch.tensor(
             weights, dtype=torch.float32
@@ -207,16 +371,17 @@ class PrioritizedReplayMemory:
 
     def update_priorities(self, indices, td_errors):
         # Ensure priorities are non-negative and account for epsilon to avoid zero priority
-        td_error_priorities = td_errors.abs() + self.epsilon
+        indices = np.asarray(indices)
+        td_error_priorities = (
+            td_errors.detach().abs().view(-1).cpu().numpy() + self.epsilon
+        )
 
         # Normalize recency bias
-        recency_bias = 1 - (
-            np.array(indices) / len(self.buffer)
-        )  # Most recent = 1, oldest = 0
+        recency_bias = 1 - (indices / len(self))  # Most recent = 1, oldest = 0
 
         # Weight TD errors and recency bias
-        for idx, (priority, recency) in zip(
-            indices, zip(td_error_priorities, recency_bias)
-        ):
-            combined_priority = self.alpha * priority + (1 - self.alpha) * recency
-            self.priorities[idx] = max(combined_priority.item(), self.min_priority)
+        combined_priority = (
+            self.alpha * td_error_priorities + (1 - self.alpha) * recency_bias
+        )
+        self.priorities[indices] = np.maximum(combined_priority, self.min_priority)
+        self._propagate_indices(indices)
@@ -130,8 +130,10 @@ class Portfolio:
             portfolio weight at the beginning of previous period
             shape=(batch_size, m_noncash_assets)
         """
-        cash_weight = 1 - wt_prev.sum()
-        wt_prime = (yt * wt_prev) / (yt.dot(wt_prev) + cash_weight)
+        cash_weight = 1 - wt_prev.sum(dim=-1, keepdim=True)
+        wt_prime = (yt * wt_prev) / (
+            (yt * wt_prev).sum(dim=-1, keepdim=True) + cash_weight
+        )
         return wt_prime
 
     def get_transacton_remainder_factor(
@@ -167,16 +169,16 @@ class Portfolio:
         wt_prime = self.get_end_of_period_weights(yt, wt_prev)
 
         # get end of period cash position for each example in batch
-        wt_cash_prime = 1 - wt_prime.sum()
+        wt_cash_prime = 1 - wt_prime.sum(dim=-1)
 
         # get cash position for portfolio weight at period t+1
-        wt_cash = 1 - wt.sum()
+        wt_cash = 1 - wt.sum(dim=-1)
 
         # initial transaction remainder factor
-        ut_k = comission_rate * torch.abs(wt - wt_prime).sum()
+        ut_k = comission_rate * torch.abs(wt - wt_prime).sum(dim=-1)
         c = comission_rate
         for _ in range(n_iter):
-            update_term = torch.relu(wt_prime - ut_k * wt).sum()
+            update_term = torch.relu(wt_prime - ut_k.unsqueeze(-1) * wt).sum(dim=-1)
             ut_k = (
                 1
                 / (1 - c * wt_cash)
@@ -198,10 +200,18 @@ class Portfolio:
         ----------
         wt : torch.tensor
             portfolio vector for beginning of period t+1
+            dim=(m_noncash_assets,) or (batch_size, m_noncash_assets)
         yt : torch.tensor
             relative price vector given by Close_t / Close(t-1)
+            dim=(m_noncash_assets,) or (batch_size, m_noncash_assets)
         wt_prev : torch.tensor
             portfolio vector weight for beginning of period t
+            dim=(m_noncash_assets,) or (batch_size, m_noncash_assets)
+
+        Returns
+        -------
+        torch.tensor
+            reward for each example, a scalar when the inputs are unbatched
         """
         rf_period = risk_free_rate / self.get_annualization_factor()
         # Risk penalty (volatility or large weight changes)
@@ -217,15 +227,17 @@ class Portfolio:
         # portfolio return before transaction cost
 
         yt_with_cash = torch.concat(
-            [torch.tensor(1 + rf_period).unsqueeze(0), yt], dim=-1
+            [torch.full_like(yt[..., :1], 1 + rf_period), yt], dim=-1
         )
         wt_prev_with_cash = torch.concat([wt_prev_cash, wt_prev], dim=-1)
-        portfolio_return = yt_with_cash.dot(wt_prev_with_cash)
+        portfolio_return = (yt_with_cash * wt_prev_with_cash).sum(dim=-1)
         portfolio_return_with_trxn_costs = ut * portfolio_return
 
         # Avoid log(0) or negative values by adding a small epsilon
         epsilon = 1e-6
-        assert portfolio_return_with_trxn_costs > 0, "portfolio return is not positive"
+        assert (
+            portfolio_return_with_trxn_costs > 0
+        ).all(), "portfolio return is not positive"
         reward = torch.log(portfolio_return_with_trxn_costs + epsilon)
 
         # Shaped reward (reward + penalties)
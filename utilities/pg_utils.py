@@ -10,22 +10,67 @@ class OrnsteinUhlenbeckNoise:
     def __init__(self, size, mu=0.0, theta=0.15, sigma=0.3, device="mps"):
         self.mu = mu
         self.theta = theta
-        self.sigma = sigma
+        self.sigma = torch.tensor(sigma, device=device)
         self.size = size
         self.device = device
         self.reset()
 
     def reset(self):
-        self.state = np.full(self.size, self.mu, dtype=np.float32)
-
-    def sample(self):
-        x = self.state
-        dx = self.theta * (self.mu - x) + self.sigma * np.random.randn(self.size)
-        self.state = x + dx
-        return torch.tensor(self.state, dtype=torch.float32, device=self.device)
-
-    def decay_sigma(self, decay_rate=0.99, min_sigma=0.05):
-        self.sigma = max(self.sigma * decay_rate, min_sigma)
+        self.state = torch.full((self.size,), self.mu, device=self.device)
+
+    def sample(self, mask=None):
+        """advances the process, only where mask is true if a mask is given, and
+        returns a copy of the new state"""
+        # x + theta * (mu - x) + sigma * N(0, 1), updated in place on device
+        noise = torch.randn(self.size, device=self.state.device)
+        if mask is None:
+            self.state.mul_(1 - self.theta).add_(
+                self.theta * self.mu + self.sigma * noise
+            )
+        else:
+            x = (
+                self.state * (1 - self.theta)
+                + self.theta * self.mu
+                + self.sigma * noise
+            )
+            self.state.copy_(torch.where(mask, x, self.state))
+        return self.state.clone()
+
+    def sample_batch(self, n, decay_rate=0.99, min_sigma=0.05, chunk_size=128):
+        """advances the process n steps, decaying sigma after each step as
+        decay_sigma does, and returns the n new states, dim = (n, size)"""
+        device = self.state.device
+        steps = torch.arange(n, dtype=torch.float32, device=device)
+        # sigma used at every step, decaying from the current sigma
+        sigma = (self.sigma * decay_rate**steps).clamp(min=min_sigma)
+        sigma = torch.where(steps == 0, self.sigma, sigma)
+        inputs = self.theta * self.mu + sigma.unsqueeze(1) * torch.randn(
+            n, self.size, device=device
+        )
+
+        # x(t+1) = a * x(t) + inputs(t) with a = 1 - theta, solved for a chunk of
+        # steps at once as x(start + i + 1) = a^(i+1) x(start) + sum_j a^(i-j) inputs(j)
+        a = 1 - self.theta
+        lags = torch.arange(chunk_size, dtype=torch.float32, device=device)
+        carry = a ** (lags + 1)
+        lags = lags.unsqueeze(1) - lags
+        weights = torch.where(lags >= 0, a ** lags.clamp(min=0), 0.0)
+        samples = []
+        for start in range(0, n, chunk_size):
+            u = inputs[start : start + chunk_size]
+            k = len(u)
+            x = carry[:k, None] * self.state + weights[:k, :k] @ u
+            self.state.copy_(x[-1])
+            samples.append(x)
+        if n > 0:
+            self.sigma.copy_((self.sigma * decay_rate**n).clamp(min=min_sigma))
+        return torch.cat(samples) if samples else inputs
+
+    def decay_sigma(self, decay_rate=0.99, min_sigma=0.05, mask=None):
+        sigma = (self.sigma * decay_rate).clamp(min=min_sigma)
+        self.sigma.copy_(
+            sigma if mask is None else torch.where(mask, sigma, self.sigma)
+        )
 
 
 class RewardNormalizer:
@@ -44,6 +89,24 @@ class RewardNormalizer:
         delta2 = reward - self.mean
         self.M2 += delta * delta2
 
+    def update_batch(self, rewards: np.ndarray):
+        """
+        Update the running statistics with a batch of rewards in one pass,
+        merging the batch moments into the running ones (Chan et al.).
+        """
+        rewards = np.asarray(rewards, dtype=np.float64).ravel()
+        n = rewards.size
+        if n == 0:
+            return
+        batch_mean = rewards.mean()
+        batch_M2 = np.square(rewards - batch_mean).sum()
+
+        total = self.count + n
+        delta = batch_mean - self.mean
+        self.mean += delta * n / total
+        self.M2 += batch_M2 + delta**2 * self.count * n / total
+        self.count = total
+
     def get_stats(self):
         """
         Get the current mean and standard deviation.
@@ -71,10 +134,32 @@ def normalize_batch_rewards(rewards):
 
 
 def plot_performance(
-    actor_losses: List[float], critic_losses: List[float], total_rewards: List[float]
+    actor_losses: List[float],
+    critic_losses: List[float],
+    total_rewards: List[float],
+    plot: bool = True,
+    prefix: str = "ddpg",
 ):
+    """
+    Plot the actor and critic losses and the rewards over episodes.
 
+    Parameters
+    ----------
+    plot : bool, optional
+        show the figures, otherwise save them as {prefix}_losses.png and
+        {prefix}_rewards.png without blocking, by default True
+    prefix : str, optional
+        file name prefix used when the figures are saved, by default "ddpg"
+    """
     episodes = range(1, len(actor_losses) + 1)
+    total_rewards = np.asarray(total_rewards, dtype=np.float32)
+
+    def finish(name):
+        if plot:
+            plt.show()
+        else:
+            plt.savefig(f"{prefix}_{name}.png")
+            plt.close()
 
     plt.figure(figsize=(12, 6))
 
@@ -86,7 +171,7 @@ def plot_performance(
     plt.ylabel("Loss")
     plt.legend()
     plt.grid(True)
-    plt.show()
+    finish("losses")
 
     plt.figure(figsize=(12, 6))
 
@@ -101,7 +186,7 @@ def plot_performance(
     plt.legend()
     plt.grid(True)
     plt.yscale("log")
-    plt.show()
+    finish("rewards")
 
 
 def set_seed(seed: int):
@@ -147,6 +232,23 @@ def compute_entropy(action_probs):
     return entropy.mean()  # Mean entropy across the batch
 
 
+def softmax_drop_first(logits):
+    """
+    Softmax over the last dimension returning only the non-cash weights.
+
+    Parameters
+    ----------
+    logits : torch.tensor
+        Tensor of shape (..., m_assets) whose first entry is the cash logit.
+
+    Returns
+    -------
+    torch.tensor
+        Tensor of shape (..., m_noncash_assets).
+    """
+    return torch.softmax(logits, dim=-1)[..., 1:]
+
+
 def standardize(data):
     mean = data.mean(dim=(0, 2), keepdim=True)
     std = data.std(dim=(0, 2), keepdim=True) + 1e-8  # Avoid division by zero